@@ -1,84 +1,268 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import http.client
 import logging
 import os
-import smtplib
+import tempfile
+import time
+import urllib.parse
+from types import MappingProxyType
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import azure.functions as func
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage # Import necessary for embedding images
 import datetime
-from typing import Dict, Optional, List, Tuple, Any # Updated typing imports
+from typing import TYPE_CHECKING, Dict, Optional, List, Set, Tuple, Any # Updated typing imports
 import json # Added for potential debug printing
 
+try:
+    import orjson # Much faster decoding of the large forecast payload
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import aiohttp # Concurrent icon downloads; otherwise (and for single icons) one keep-alive http.client connection
+except ImportError:
+    aiohttp = None
+
+if TYPE_CHECKING:
+    import smtplib # Imported lazily at runtime, only when an email is sent
+
 # --- Logging Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+# The Azure Functions worker configures the handlers; just log through a module logger
+logger = logging.getLogger(__name__)
 
 app = func.FunctionApp()
 
 # --- Constants ---
 ACCUWEATHER_BASE_URL = "http://dataservice.accuweather.com"
+# AccuWeather icon URLs need a zero-padded icon code, e.g. .../files/01-s.png
+ACCUWEATHER_ICON_HOST = "developer.accuweather.com"
+ACCUWEATHER_ICON_PATH = "/sites/default/files/{code}-s.png"
+ACCUWEATHER_ICON_URL = "https://" + ACCUWEATHER_ICON_HOST + ACCUWEATHER_ICON_PATH
+HTTP_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# AccuWeather icons never change, so keep downloaded copies on the instance's local disk
+ICON_CACHE_DIR = os.path.join(tempfile.gettempdir(), "aw_icons")
+# A complete PNG starts with this signature and ends with the IEND chunk; anything else in the cache is re-downloaded
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND_TRAILER = b"IEND\xaeB`\x82"
+# Location Keys are stable per coordinate pair; cache them in-process and on disk for cold starts
+LOCATION_KEY_CACHE_FILE = os.path.join(tempfile.gettempdir(), "aw_location_key.json")
+LOCATION_KEY_CACHE_TTL = 30 * 86400 # 30 days, in seconds
+# Digest of the last email sent (sender, recipient, subject, HTML), so an identical email is not sent twice
+LAST_EMAIL_DIGEST_FILE = os.path.join(tempfile.gettempdir(), "last_fc.txt")
+
+_location_key_cache: Dict[str, str] = {} # {"lat,lon": location_key}
+
+_WIND_DIRECTIONS = (
+    "N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+    "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW",
+)
+# Compass point for every whole degree, precomputed so lookups are a single index
+_WIND_DIRECTIONS_BY_DEGREE = tuple(_WIND_DIRECTIONS[int((d + 11.25) / 22.5) % 16] for d in range(360))
+
+# Shared read-only defaults for missing sections of the forecast JSON (avoids a new {} / [] per lookup)
+_EMPTY: Any = MappingProxyType({})
+_EMPTY_LIST: Tuple[()] = ()
+
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# --- Email Templates ---
+# Module-level render functions; f-strings are far cheaper than string.Template.substitute()
+
+def render_email_html(actual_days: int, city: str, summary_items: str, day_sections: str) -> str:
+    """Renders the complete forecast email around the pre-rendered summary items and day sections."""
+    return f"""
+<html>
+<head>
+  <style>
+    body {{ font-family: sans-serif; line-height: 1.5; }}
+    h1 {{ color: #333; }}
+    h2 {{ color: #555; border-bottom: 1px solid #eee; padding-bottom: 5px; margin-top: 20px;}}
+    .day-forecast {{ margin-bottom: 15px; padding: 10px; border: 1px solid #ddd; border-radius: 5px; background-color: #f9f9f9; }}
+    .weather-icon {{ vertical-align: middle; width: 75px; height: 45px; margin-right: 10px; object-fit: contain; }} /* Adjusted size for AccuWeather icons */
+    .summary-container {{ display: flex; flex-direction: row; flex-wrap: wrap; justify-content: flex-start; margin-bottom: 20px; }}
+    .summary-item {{ display: flex; flex-direction: column; align-items: center; border: 1px solid #eee; padding: 8px; margin: 5px; border-radius: 5px; min-width: 60px; text-align: center;}}
+    .summary-day {{ font-size: 0.8em; color: #777; margin-bottom: 5px; }}
+    .summary-icon-small {{ width: 45px; height: 27px; vertical-align: middle; object-fit: contain;}} /* Adjusted size */
+    strong {{ color: #444; }}
+    .detail-label {{ display: inline-block; min-width: 100px; }} /* Align details */
+  </style>
+</head>
+<body>
+  <h1>🗓️ {actual_days}-Day Weather Forecast for {city}</h1>
+  <div class="summary-container">
+{summary_items}
+  </div>
+{day_sections}
+  <p><i>Weather data provided by AccuWeather.</i></p> </body>
+</html>
+"""
+
+
+def render_summary_item(day_name: str, icon_html: str) -> str:
+    """Renders one day's entry in the icon summary line."""
+    return f"""
+    <div class="summary-item">
+      <div class="summary-day">{day_name}</div>
+      {icon_html}
+    </div>
+"""
+
+
+def render_day_section(day_forecast: Dict, img_tag: str) -> str:
+    """Renders one day's detailed forecast section."""
+    date_obj = day_forecast.get('date_obj')
+    return f"""
+  <div class="day-forecast">
+    <h2>{day_forecast.get('day_name', '')}, {date_obj.strftime('%B %d') if date_obj else ''}</h2>
+    <p>
+      {img_tag} <br>
+      <span class="detail-label"><strong>Weather:</strong></span> {day_forecast.get('weather_desc', 'N/A')} <br>
+      <span class="detail-label"><strong>🌡️ High/Low:</strong></span> {day_forecast.get('high_temp', 'N/A')}°C / {day_forecast.get('low_temp', 'N/A')}°C <br>
+      <span class="detail-label"><strong>💨 Wind:</strong></span> {day_forecast.get('wind_speed', 'N/A')} m/s ({day_forecast.get('wind_direction', 'N/A')}) <br>
+      <span class="detail-label"><strong>💧 Humidity:</strong></span> {day_forecast.get('humidity', 'N/A')} <br> <span class="detail-label"><strong>🌧️ Precip:</strong></span> {day_forecast.get('precipitation', 'N/A')} mm ({day_forecast.get('precip_chance', 'N/A')}% chance) <br>
+      <span class="detail-label"><strong>☀️ UV Index:</strong></span> {day_forecast.get('uv_index', 'N/A')} <br>
+      <span class="detail-label"><strong>🌅 Sunrise:</strong></span> {day_forecast.get('sunrise', 'N/A')} / <strong>🌇 Sunset:</strong> {day_forecast.get('sunset', 'N/A')}
+    </p>
+  </div>
+"""
 
 # --- Helper Functions ---
 
 def get_wind_direction(degrees: Optional[int]) -> str:
     """Converts wind direction in degrees to a readable format (N, NE, E, SE, etc.)."""
-    directions = [
-        "N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
-        "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW",
-    ]
     if degrees is None:
         return "N/A"
     try:
         # Ensure degrees is treated as a number
-        degrees = int(degrees)
-        return directions[int((degrees + 11.25) / 22.5) % 16]
-    except (ValueError, TypeError, IndexError):
-        logging.warning(f"Could not parse wind direction degrees: {degrees}")
+        return _WIND_DIRECTIONS_BY_DEGREE[int(degrees) % 360]
+    except (ValueError, TypeError):
+        logger.warning(f"Could not parse wind direction degrees: {degrees}")
         return "N/A"
 
-def get_accuweather_location_key(lat: str, lon: str, api_key: str) -> Optional[str]:
-    """Gets the AccuWeather Location Key for given latitude and longitude."""
+
+def _read_cached_location_key(coords: str) -> Optional[str]:
+    """Returns the Location Key stored in the on-disk cache for coords, if present and not expired."""
+    try:
+        with open(LOCATION_KEY_CACHE_FILE, "r", encoding="utf-8") as cache_file:
+            entry = json.load(cache_file).get(coords)
+        if entry and time.time() - entry["timestamp"] < LOCATION_KEY_CACHE_TTL:
+            return entry["key"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass # Missing or unreadable cache just means a fresh lookup
+    return None
+
+
+def _write_cached_location_key(coords: str, location_key: str) -> None:
+    """Stores the Location Key for coords in the on-disk cache, keeping other entries."""
+    try:
+        with open(LOCATION_KEY_CACHE_FILE, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+        if not isinstance(cache, dict):
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+    cache[coords] = {"key": location_key, "timestamp": time.time()}
+    try:
+        with open(LOCATION_KEY_CACHE_FILE, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not write AccuWeather location key cache: {e}")
+
+
+def create_http_session() -> requests.Session:
+    """
+    Creates a requests Session that reuses connections across AccuWeather API calls
+    and retries transient failures (including 429 rate limiting) with backoff.
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False # Return the last response so raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def format_iso_time(iso_str: str) -> str:
+    """
+    Formats an AccuWeather ISO 8601 timestamp (e.g. "2025-04-11T06:00:00+01:00") as
+    "06:00AM UTC+01:00" (same output as strftime("%I:%M%p %Z")) by slicing the string
+    instead of parsing it into a datetime.
+    """
+    hour = int(iso_str[11:13])
+    minute = iso_str[14:16]
+    if not minute.isdigit():
+        raise ValueError(f"Invalid ISO 8601 time: {iso_str}")
+    offset = iso_str[19:].lstrip(".0123456789") # Skip seconds' fraction, if any
+    if not offset:
+        tz_name = ""
+    elif offset in ("Z", "+00:00", "-00:00"):
+        tz_name = "UTC"
+    else:
+        tz_name = f"UTC{offset}"
+    return f"{hour % 12 or 12:02d}:{minute}{'AM' if hour < 12 else 'PM'} {tz_name}"
+
+
+def get_accuweather_location_key(session: requests.Session, lat: str, lon: str, api_key: str) -> Optional[str]:
+    """
+    Gets the AccuWeather Location Key for given latitude and longitude.
+    Keys are cached in memory and on disk (for LOCATION_KEY_CACHE_TTL) to skip the lookup on later runs.
+    """
+    coords = f"{lat},{lon}"
+    location_key = _location_key_cache.get(coords) or _read_cached_location_key(coords)
+    if location_key:
+        logger.info(f"Using cached AccuWeather Location Key: {location_key} for ({lat}, {lon})")
+        _location_key_cache[coords] = location_key
+        return location_key
+
     url = f"{ACCUWEATHER_BASE_URL}/locations/v1/cities/geoposition/search"
     params = {
         "apikey": api_key,
-        "q": f"{lat},{lon}",
+        "q": coords,
         "language": "en-us", # Optional: specify language
         "toplevel": "false" # Optional: retrieve only the location itself
     }
     try:
-        response = requests.get(url, params=params)
+        response = session.get(url, params=params)
         response.raise_for_status() # Check for HTTP errors
-        data = response.json()
+        data = json_loads(response.content)
 
         if data and isinstance(data, dict) and "Key" in data:
-            logging.info(f"Found AccuWeather Location Key: {data['Key']} for ({lat}, {lon})")
+            logger.info(f"Found AccuWeather Location Key: {data['Key']} for ({lat}, {lon})")
+            _location_key_cache[coords] = data["Key"]
+            _write_cached_location_key(coords, data["Key"])
             return data["Key"]
         else:
-            logging.error(f"Could not find Location Key in AccuWeather response: {data}")
+            logger.error(f"Could not find Location Key in AccuWeather response: {data}")
             return None
 
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching AccuWeather location key: {e}")
+        logger.error(f"Error fetching AccuWeather location key: {e}")
         # Log response text if available for debugging rate limits etc.
         if hasattr(e, 'response') and e.response is not None:
-            logging.error(f"AccuWeather Location API Response: {e.response.text}")
+            logger.error(f"AccuWeather Location API Response: {e.response.text}")
         return None
     except (KeyError, ValueError, TypeError) as e:
-        logging.error(f"Error parsing AccuWeather location key response: {e}")
+        logger.error(f"Error parsing AccuWeather location key response: {e}")
         return None
 
 
-def get_accuweather_forecast(location_key: str, api_key: str, days: int = 5) -> Optional[List[Dict]]:
+def get_accuweather_forecast(session: requests.Session, location_key: str, api_key: str, days: int = 5) -> Optional[List[Dict]]:
     """
     Fetches the daily weather forecast from AccuWeather for a given Location Key.
     Note: Free tier might be limited to 1-day or 5-day forecasts. Adjust 'days' accordingly.
     Common endpoints: /1day/, /5day/, /10day/, /15day/
     """
     if days not in [1, 5, 10, 15]:
-        logging.warning(f"Unsupported number of forecast days requested: {days}. Defaulting to 5.")
+        logger.warning(f"Unsupported number of forecast days requested: {days}. Defaulting to 5.")
         days = 5 # Default or adjust based on your AccuWeather plan
 
     url = f"{ACCUWEATHER_BASE_URL}/forecasts/v1/daily/{days}day/{location_key}"
@@ -91,33 +275,42 @@ def get_accuweather_forecast(location_key: str, api_key: str, days: int = 5) ->
     weekly_forecast = []
 
     try:
-        response = requests.get(url, params=params)
+        response = session.get(url, params=params)
         response.raise_for_status()
-        data = response.json()
-        # logging.debug(f"AccuWeather Forecast Response: {json.dumps(data, indent=2)}") # Uncomment for detailed debugging
+        data = json_loads(response.content)
+        # logger.debug(f"AccuWeather Forecast Response: {json.dumps(data, indent=2)}") # Uncomment for detailed debugging
 
         if not data or "DailyForecasts" not in data:
-            logging.error("AccuWeather forecast response is missing 'DailyForecasts'.")
+            logger.error("AccuWeather forecast response is missing 'DailyForecasts'.")
             return None
 
-        for daily_data in data["DailyForecasts"]:
+        # Local aliases for names used on every iteration of the loop below
+        fromtimestamp = datetime.datetime.fromtimestamp
+        utc = datetime.timezone.utc
+        weekly_forecast_append = weekly_forecast.append
+
+        # Sort by date just in case the API doesn't guarantee order (integer epoch compare; missing dates first)
+        daily_forecasts = sorted(data["DailyForecasts"], key=lambda daily: daily.get("EpochDate") or 0)
+
+        for daily_data in daily_forecasts:
             # --- Safely extract data using .get() ---
-            temp_data = daily_data.get("Temperature", {})
-            day_data = daily_data.get("Day", {})
-            wind_data = day_data.get("Wind", {})
-            wind_speed_data = wind_data.get("Speed", {})
-            wind_direction_data = wind_data.get("Direction", {})
-            sun_data = daily_data.get("Sun", {})
-            air_and_pollen = daily_data.get("AirAndPollen", [])
-
-            # Find UV Index
-            uv_index_info = next((item for item in air_and_pollen if item.get("Name") == "UVIndex"), None)
+            temp_data = daily_data.get("Temperature", _EMPTY)
+            day_data = daily_data.get("Day", _EMPTY)
+            wind_data = day_data.get("Wind", _EMPTY)
+            wind_speed_data = wind_data.get("Speed", _EMPTY)
+            wind_direction_data = wind_data.get("Direction", _EMPTY)
+            sun_data = daily_data.get("Sun", _EMPTY)
+            air_and_pollen = daily_data.get("AirAndPollen", _EMPTY_LIST)
+
+            # Index AirAndPollen categories (UVIndex, AirQuality, Grass, Mold, ...) by name
+            air_and_pollen_by_name = {item.get("Name"): item for item in air_and_pollen}
+            uv_index_info = air_and_pollen_by_name.get("UVIndex")
             uv_index = f"{uv_index_info.get('Value')} ({uv_index_info.get('Category')})" if uv_index_info else "N/A"
 
             # Handle Precipitation - AccuWeather separates rain, snow, ice
-            precip_value = day_data.get("Rain", {}).get("Value", 0) + \
-                           day_data.get("Snow", {}).get("Value", 0) + \
-                           day_data.get("Ice", {}).get("Value", 0)
+            precip_value = day_data.get("Rain", _EMPTY).get("Value", 0) + \
+                           day_data.get("Snow", _EMPTY).get("Value", 0) + \
+                           day_data.get("Ice", _EMPTY).get("Value", 0)
             precip_prob = day_data.get("PrecipitationProbability", 0) # Already a percentage
 
             # Wind speed conversion from km/h to m/s (1 m/s = 3.6 km/h)
@@ -126,22 +319,18 @@ def get_accuweather_forecast(location_key: str, api_key: str, days: int = 5) ->
 
             # Date/Time parsing
             epoch_date = daily_data.get("EpochDate")
-            date_obj = datetime.datetime.fromtimestamp(epoch_date, tz=datetime.timezone.utc) if epoch_date else None
-            date_str = date_obj.strftime("%Y-%m-%d") if date_obj else "N/A"
-            day_name = date_obj.strftime("%A") if date_obj else "N/A"
+            date_obj = fromtimestamp(epoch_date, tz=utc) if epoch_date else None
+            date_str = f"{date_obj.year:04d}-{date_obj.month:02d}-{date_obj.day:02d}" if date_obj else "N/A"
+            day_name = WEEKDAY_NAMES[date_obj.weekday()] if date_obj else "N/A"
 
             sunrise_str = sun_data.get("Rise")
             sunset_str = sun_data.get("Set")
             # AccuWeather provides ISO 8601 format (e.g., "2025-04-11T06:00:00+01:00")
-            # Parse and format it
             try:
-                sunrise_dt = datetime.datetime.fromisoformat(sunrise_str) if sunrise_str else None
-                sunset_dt = datetime.datetime.fromisoformat(sunset_str) if sunset_str else None
-                # Format to %I:%M%p %Z (adjust timezone as needed or display offset)
-                sunrise_formatted = sunrise_dt.strftime("%I:%M%p %Z") if sunrise_dt else "N/A"
-                sunset_formatted = sunset_dt.strftime("%I:%M%p %Z") if sunset_dt else "N/A"
+                sunrise_formatted = format_iso_time(sunrise_str) if sunrise_str else "N/A"
+                sunset_formatted = format_iso_time(sunset_str) if sunset_str else "N/A"
             except (ValueError, TypeError) as dt_err:
-                 logging.warning(f"Could not parse sunrise/sunset: {sunrise_str}, {sunset_str} - Error: {dt_err}")
+                 logger.warning(f"Could not parse sunrise/sunset: {sunrise_str}, {sunset_str} - Error: {dt_err}")
                  sunrise_formatted = "N/A"
                  sunset_formatted = "N/A"
 
@@ -149,8 +338,8 @@ def get_accuweather_forecast(location_key: str, api_key: str, days: int = 5) ->
             forecast = {
                 "weather_desc": day_data.get("IconPhrase", "N/A").capitalize(),
                 "icon": day_data.get("Icon"), # AccuWeather Icon Number (1-44)
-                "high_temp": round(temp_data.get("Maximum", {}).get("Value", 0), 1),
-                "low_temp": round(temp_data.get("Minimum", {}).get("Value", 0), 1),
+                "high_temp": round(temp_data.get("Maximum", _EMPTY).get("Value", 0), 1),
+                "low_temp": round(temp_data.get("Minimum", _EMPTY).get("Value", 0), 1),
                 "wind_speed": wind_speed_ms, # In m/s after conversion
                 "wind_direction": get_wind_direction(wind_direction_data.get("Degrees")),
                 "humidity": "N/A", # Often not in AccuWeather daily forecast summary
@@ -164,62 +353,255 @@ def get_accuweather_forecast(location_key: str, api_key: str, days: int = 5) ->
                 "date_str": date_str,
                 "day_name": day_name
             }
-            weekly_forecast.append(forecast)
-
-        # Sort by date just in case the API doesn't guarantee order
-        weekly_forecast.sort(key=lambda x: x["date_obj"] or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
+            weekly_forecast_append(forecast)
 
         # Limit to the number of days actually requested/returned if API gives more/less
         return weekly_forecast[:days]
 
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching AccuWeather forecast data: {e}")
+        logger.error(f"Error fetching AccuWeather forecast data: {e}")
         if hasattr(e, 'response') and e.response is not None:
-            logging.error(f"AccuWeather Forecast API Response: {e.response.text}") # Log response for debugging
+            logger.error(f"AccuWeather Forecast API Response: {e.response.text}") # Log response for debugging
         return None
     except (KeyError, ValueError, TypeError, IndexError) as e:
-        logging.error(f"Error parsing AccuWeather forecast data: {e}")
+        logger.error(f"Error parsing AccuWeather forecast data: {e}")
         # Consider logging the raw 'daily_data' item that caused the error if debugging
         return None
 
 
+async def _fetch_icons(icon_codes: Set[str]) -> Dict[str, Optional[bytes]]:
+    """
+    Downloads the given AccuWeather icons concurrently over one connection pool.
+    Returns {icon_code_str: image_bytes}, with None for icons that could not be fetched.
+    """
+    async def fetch_icon(session: aiohttp.ClientSession, icon_code_str: str) -> Tuple[str, Optional[bytes]]:
+        icon_url = ACCUWEATHER_ICON_URL.format(code=icon_code_str)
+        try:
+            async with session.get(icon_url) as icon_response:
+                icon_response.raise_for_status()
+                return icon_code_str, await icon_response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as img_err:
+            logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({icon_url}): {img_err}")
+            return icon_code_str, None # Mark as failed
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16)) as session:
+        results = await asyncio.gather(*(fetch_icon(session, code) for code in icon_codes))
+    return dict(results)
+
+
+def _get_over_connection(conn: http.client.HTTPConnection, path: str) -> Tuple[http.client.HTTPResponse, bytes]:
+    """Issues a GET on conn and returns the response with its fully drained body."""
+    conn.request("GET", path)
+    response = conn.getresponse()
+    return response, response.read() # Drain the body so the connection can be reused
+
+
+def _fetch_icons_sequential(icon_codes: Set[str]) -> Dict[str, Optional[bytes]]:
+    """
+    Downloads the given AccuWeather icons one after another over a single kept-alive
+    HTTPS connection, following at most one redirect per icon. Same return value as _fetch_icons.
+    """
+    icons: Dict[str, Optional[bytes]] = {}
+    conn = http.client.HTTPSConnection(ACCUWEATHER_ICON_HOST, timeout=10)
+    try:
+        for icon_code_str in icon_codes:
+            icon_url = ACCUWEATHER_ICON_URL.format(code=icon_code_str)
+            icons[icon_code_str] = None # Mark as failed until the icon arrives
+            try:
+                icon_response, icon_bytes = _get_over_connection(conn, ACCUWEATHER_ICON_PATH.format(code=icon_code_str))
+            except (http.client.HTTPException, OSError) as img_err:
+                logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({icon_url}): {img_err}")
+                conn.close() # Connection is broken; reconnects on the next request
+                continue
+
+            if icon_response.status in HTTP_REDIRECT_STATUSES:
+                location = icon_response.getheader("Location")
+                if not location:
+                    logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({icon_url}): HTTP {icon_response.status} redirect without a Location header")
+                    continue
+                target = urllib.parse.urlsplit(urllib.parse.urljoin(icon_url, location))
+                target_path = urllib.parse.urlunsplit(("", "", target.path or "/", target.query, ""))
+                logger.info(f"AccuWeather icon {icon_code_str} redirected ({icon_response.status}) to {target.geturl()}")
+                same_host = target.scheme == "https" and target.netloc == ACCUWEATHER_ICON_HOST
+                if same_host:
+                    redirect_conn = conn
+                else:
+                    # Different host or scheme: use a one-off connection for the redirect target
+                    connection_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+                    redirect_conn = connection_class(target.netloc, timeout=10)
+                try:
+                    icon_response, icon_bytes = _get_over_connection(redirect_conn, target_path)
+                except (http.client.HTTPException, OSError) as img_err:
+                    logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({target.geturl()}): {img_err}")
+                    redirect_conn.close()
+                    continue
+                finally:
+                    if not same_host:
+                        redirect_conn.close()
+                if icon_response.status in HTTP_REDIRECT_STATUSES:
+                    logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({icon_url}): HTTP {icon_response.status} redirected more than once; not following")
+                    continue
+
+            if icon_response.status != 200:
+                # Body was drained, so the kept-alive connection stays usable for the next icon
+                logger.warning(f"Could not fetch AccuWeather icon {icon_code_str} ({icon_url}): HTTP {icon_response.status} {icon_response.reason}")
+                continue
+            icons[icon_code_str] = icon_bytes
+    finally:
+        conn.close()
+    return icons
+
+
+def _write_cached_icon(icon_code_str: str, icon_bytes: bytes) -> None:
+    """
+    Stores an icon in the local icon cache. The bytes go to a temp file first and are then
+    renamed into place, so a crash or full disk never leaves a partial icon behind.
+    """
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=ICON_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as icon_file:
+            icon_file.write(icon_bytes)
+        os.replace(tmp_path, os.path.join(ICON_CACHE_DIR, f"{icon_code_str}-s.png"))
+    except OSError as e:
+        logger.warning(f"Could not cache AccuWeather icon {icon_code_str}: {e}")
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass # Already renamed or never created
+
+
+def get_icons(icon_codes: Set[str]) -> Dict[str, Optional[bytes]]:
+    """
+    Returns {icon_code_str: image_bytes} for the given icon codes, reading from the
+    local icon cache and downloading (then caching) only the icons not yet on disk.
+    """
+    icons: Dict[str, Optional[bytes]] = {}
+    missing_codes = set()
+    try:
+        os.makedirs(ICON_CACHE_DIR, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not create icon cache directory {ICON_CACHE_DIR}: {e}")
+
+    for icon_code_str in icon_codes:
+        icon_path = os.path.join(ICON_CACHE_DIR, f"{icon_code_str}-s.png")
+        try:
+            with open(icon_path, "rb") as icon_file:
+                icon_bytes = icon_file.read()
+        except OSError:
+            icon_bytes = b""
+        if icon_bytes.startswith(PNG_SIGNATURE) and icon_bytes.endswith(PNG_IEND_TRAILER):
+            icons[icon_code_str] = icon_bytes
+        else:
+            missing_codes.add(icon_code_str) # Not cached yet, or an empty/truncated file
+
+    if missing_codes:
+        logger.info(f"Downloading {len(missing_codes)} uncached AccuWeather icon(s)...")
+        # Concurrency only pays off for several icons (typically the first run); a single miss
+        # on a warm cache is cheaper over one plain connection than an event loop + aiohttp session
+        if aiohttp is not None and len(missing_codes) > 1:
+            downloaded = asyncio.run(_fetch_icons(missing_codes))
+        else:
+            downloaded = _fetch_icons_sequential(missing_codes)
+        for icon_code_str, icon_bytes in downloaded.items():
+            icons[icon_code_str] = icon_bytes
+            if icon_bytes:
+                _write_cached_icon(icon_code_str, icon_bytes)
+
+    return icons
+
+
+def get_email_digest(from_email: str, to_email: str, subject: str, html_content: str) -> str:
+    """Returns a hash of everything that ends up in the forecast email, used to detect repeat sends."""
+    canonical = "\0".join((from_email, to_email, subject, html_content))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def read_last_email_digest() -> Optional[str]:
+    """Returns the digest of the last email sent, if one was recorded."""
+    try:
+        with open(LAST_EMAIL_DIGEST_FILE, "r", encoding="utf-8") as digest_file:
+            return digest_file.read().strip() or None
+    except OSError:
+        return None
+
+
+def write_last_email_digest(digest: str) -> None:
+    """Records the digest of the email just sent."""
+    try:
+        with open(LAST_EMAIL_DIGEST_FILE, "w", encoding="utf-8") as digest_file:
+            digest_file.write(digest)
+    except OSError as e:
+        logger.warning(f"Could not record last email digest: {e}")
+
+
+def connect_smtp(user: str, password: str) -> "smtplib.SMTP_SSL":
+    """Opens an authenticated Gmail SMTP connection (TLS handshake + AUTH)."""
+    import smtplib
+    logger.info("Connecting to SMTP server...")
+    server = smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=30)
+    server.login(user, password)
+    return server
+
+
+def quit_smtp(server: "smtplib.SMTP_SSL") -> None:
+    """Ends the SMTP session politely, falling back to dropping the socket if QUIT fails."""
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def close_smtp(smtp_future: "concurrent.futures.Future[smtplib.SMTP_SSL]") -> None:
+    """Closes a background SMTP connection that is no longer needed, ignoring connect errors."""
+    try:
+        server = smtp_future.result()
+    except Exception:
+        return # Nothing to clean up if the connection never came up
+    quit_smtp(server)
+
+
 def send_email_with_images(
+    server: "smtplib.SMTP_SSL",
     user: str,
-    password: str,
     to_email: str,
     subject: str,
     html_content: str,
     images: List[Tuple[bytes, str]] # List of (image_bytes, content_id)
-) -> None:
-    """Sends an HTML email with embedded images using Gmail SMTP. (No changes needed here)"""
-    try:
-        msg_root = MIMEMultipart('related')
-        msg_root['Subject'] = subject
-        msg_root['From'] = user
-        msg_root['To'] = to_email
-        msg_root.preamble = 'This is a multi-part message in MIME format.'
-
-        msg_alternative = MIMEMultipart('alternative')
-        msg_root.attach(msg_alternative)
-        msg_alternative.attach(MIMEText(html_content, 'html'))
+) -> bool:
+    """
+    Sends an HTML email with embedded images over an already-connected SMTP server
+    (see connect_smtp). The connection is always closed afterwards. Returns True if the email was sent.
+    """
+    import smtplib
+    from email.message import EmailMessage
 
+    try:
+        msg = EmailMessage()
+        msg['Subject'] = subject
+        msg['From'] = user
+        msg['To'] = to_email
+        msg.set_content("Your weather forecast is best viewed in an HTML-capable email client.")
+        msg.add_alternative(html_content, subtype='html')
+
+        # Embed images alongside the HTML part (multipart/related) so cid: references resolve
+        html_part = msg.get_payload()[1]
         for img_data, img_cid in images:
-            img = MIMEImage(img_data)
-            img.add_header('Content-ID', f'<{img_cid}>')
-            msg_root.attach(img)
-
-        logging.info("Connecting to SMTP server...")
-        server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-        server.login(user, password)
-        logging.info("Sending email...")
-        server.sendmail(user, to_email, msg_root.as_string())
-        server.quit()
-        logging.info(f"Email sent to {to_email} successfully!")
+            html_part.add_related(img_data, 'image', 'png', cid=f'<{img_cid}>')
+
+        logger.info("Sending email...")
+        server.send_message(msg)
+        logger.info(f"Email sent to {to_email} successfully!")
+        return True
 
     except smtplib.SMTPException as e:
-        logging.error(f"Error sending email: SMTP error - {e}")
+        logger.error(f"Error sending email: SMTP error - {e}")
     except Exception as e:
-        logging.error(f"Error sending email: Unexpected error - {e}")
+        logger.error(f"Error sending email: Unexpected error - {e}")
+    finally:
+        quit_smtp(server)
+    return False
 
 
 # --- Azure Function ---
@@ -236,9 +618,9 @@ def WeatherAlert(myTimer: func.TimerRequest) -> None:
     and send an email notification with embedded icons.
     """
     if myTimer.past_due:
-        logging.warning("The timer is past due!")
+        logger.warning("The timer is past due!")
 
-    logging.info("WeatherNotifier function started (AccuWeather Version).")
+    logger.info("WeatherNotifier function started (AccuWeather Version).")
 
     # --- Configuration ---
     accuweather_api_key = os.getenv("ACCUWEATHER_API_KEY") # <-- Changed variable name
@@ -261,7 +643,7 @@ def WeatherAlert(myTimer: func.TimerRequest) -> None:
     }
     missing_vars = [name for name, value in required_vars.items() if not value]
     if missing_vars:
-        logging.error(f"Missing environment variables: {', '.join(missing_vars)}")
+        logger.error(f"Missing environment variables: {', '.join(missing_vars)}")
         return
 
     try:
@@ -270,156 +652,108 @@ def WeatherAlert(myTimer: func.TimerRequest) -> None:
         if not (1 <= forecast_days <= 15):
              raise ValueError("FORECAST_DAYS must be between 1 and 15.")
     except ValueError as e:
-        logging.error(f"Configuration error: {e}. Ensure LATITUDE/LONGITUDE are numeric and FORECAST_DAYS is valid.")
+        logger.error(f"Configuration error: {e}. Ensure LATITUDE/LONGITUDE are numeric and FORECAST_DAYS is valid.")
         return
 
-    # --- Fetch AccuWeather Location Key ---
-    logging.info(f"Fetching AccuWeather Location Key for {city} ({lat}, {lon})...")
-    location_key = get_accuweather_location_key(lat, lon, accuweather_api_key)
-
-    if not location_key:
-        logging.error("Failed to get AccuWeather Location Key. Cannot proceed.")
-        return # Stop execution if we don't have the key
-
-    # --- Fetch AccuWeather Forecast Data ---
-    logging.info(f"Fetching {forecast_days}-day AccuWeather forecast using Location Key {location_key}...")
-    forecast_data = get_accuweather_forecast(location_key, accuweather_api_key, forecast_days)
-
-    if forecast_data:
-        actual_days = len(forecast_data) # Use the actual number of days returned
-        email_subject = f"🌦️ {actual_days}-Day AccuWeather Forecast for {city}"
-        email_images = [] # To store (image_bytes, content_id) tuples
-
-        # --- Start HTML ---
-        html_content = f"""
-        <html>
-        <head>
-          <style>
-            body {{ font-family: sans-serif; line-height: 1.5; }}
-            h1 {{ color: #333; }}
-            h2 {{ color: #555; border-bottom: 1px solid #eee; padding-bottom: 5px; margin-top: 20px;}}
-            .day-forecast {{ margin-bottom: 15px; padding: 10px; border: 1px solid #ddd; border-radius: 5px; background-color: #f9f9f9; }}
-            .weather-icon {{ vertical-align: middle; width: 75px; height: 45px; margin-right: 10px; object-fit: contain; }} /* Adjusted size for AccuWeather icons */
-            .summary-container {{ display: flex; flex-direction: row; flex-wrap: wrap; justify-content: flex-start; margin-bottom: 20px; }}
-            .summary-item {{ display: flex; flex-direction: column; align-items: center; border: 1px solid #eee; padding: 8px; margin: 5px; border-radius: 5px; min-width: 60px; text-align: center;}}
-            .summary-day {{ font-size: 0.8em; color: #777; margin-bottom: 5px; }}
-            .summary-icon-small {{ width: 45px; height: 27px; vertical-align: middle; object-fit: contain;}} /* Adjusted size */
-            strong {{ color: #444; }}
-            .detail-label {{ display: inline-block; min-width: 100px; }} /* Align details */
-          </style>
-        </head>
-        <body>
-          <h1>🗓️ {actual_days}-Day Weather Forecast for {city}</h1>
-          <div class="summary-container">
-        """
-
-        # --- Create Image Summary Line ---
-        fetched_icons = {} # Cache fetched icons: {icon_code: image_bytes}
-        for day_forecast in forecast_data:
-            icon_code = day_forecast.get('icon')
-            date_str = day_forecast.get('date_str', 'no_date')
-            weather_desc = day_forecast.get('weather_desc', 'N/A')
-            day_name = day_forecast.get('day_name', 'N/A')
-
-            if icon_code:
-                # AccuWeather icon URLs format: https://developer.accuweather.com/sites/default/files/01-s.png (needs zero padding)
-                icon_code_str = str(icon_code).zfill(2) # Pad with zero if needed (e.g., 1 -> "01")
-                icon_url = f"https://developer.accuweather.com/sites/default/files/{icon_code_str}-s.png"
-                image_cid = f"summary_icon_{date_str}_{icon_code_str}" # Unique CID
-
-                if icon_code_str not in fetched_icons:
-                    try:
-                        icon_response = requests.get(icon_url)
-                        icon_response.raise_for_status()
-                        icon_bytes = icon_response.content
-                        fetched_icons[icon_code_str] = icon_bytes # Cache it
-                        email_images.append((icon_bytes, image_cid))
-                    except requests.exceptions.RequestException as img_err:
-                        logging.warning(f"Could not fetch summary AccuWeather icon {icon_code_str} ({icon_url}): {img_err}")
-                        fetched_icons[icon_code_str] = None # Mark as failed
-                else:
-                    # Use cached icon if already fetched/attempted
+    # --- Connect to SMTP in the background ---
+    # The TLS handshake + AUTH overlaps with the forecast/icon fetches below
+    smtp_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    smtp_future = smtp_executor.submit(connect_smtp, gmail_user, gmail_password)
+    smtp_executor.shutdown(wait=False)
+
+    smtp_handed_off = False
+    try:
+        http_session = create_http_session() # Shared by both AccuWeather API calls
+        try:
+            # --- Fetch AccuWeather Location Key ---
+            logger.info(f"Fetching AccuWeather Location Key for {city} ({lat}, {lon})...")
+            location_key = get_accuweather_location_key(http_session, lat, lon, accuweather_api_key)
+
+            if not location_key:
+                logger.error("Failed to get AccuWeather Location Key. Cannot proceed.")
+                return # Stop execution if we don't have the key
+
+            # --- Fetch AccuWeather Forecast Data ---
+            logger.info(f"Fetching {forecast_days}-day AccuWeather forecast using Location Key {location_key}...")
+            forecast_data = get_accuweather_forecast(http_session, location_key, accuweather_api_key, forecast_days)
+        finally:
+            http_session.close()
+
+        if forecast_data:
+            actual_days = len(forecast_data) # Use the actual number of days returned
+            email_subject = f"🌦️ {actual_days}-Day AccuWeather Forecast for {city}"
+            email_images = [] # To store (image_bytes, content_id) tuples
+
+            # --- Fetch Icons ---
+            # Derive the padded code string and CID once per distinct icon (e.g., 1 -> ("01", "aw_icon_01"))
+            icon_meta: Dict[Any, Tuple[str, str]] = {}
+            for day_forecast in forecast_data:
+                icon_code = day_forecast.get('icon')
+                if icon_code and icon_code not in icon_meta:
+                    icon_code_str = str(icon_code).zfill(2) # Cannot fail, whatever type the API sent
+                    icon_meta[icon_code] = (icon_code_str, f"aw_icon_{icon_code_str}") # One CID per icon, shared by all days
+            fetched_icons = get_icons({code_str for code_str, _ in icon_meta.values()}) # {icon_code: image_bytes}
+
+            # --- Create Image Summary Line ---
+            summary_items: List[str] = []
+            added_cids: Set[str] = set() # Each icon is attached once, however many days use it
+            for day_forecast in forecast_data:
+                icon_code = day_forecast.get('icon')
+                weather_desc = day_forecast.get('weather_desc', 'N/A')
+                icon_html = f"({weather_desc})" # Shown when there is no icon code or the fetch failed
+                day_forecast["_img_tag"] = '(icon unavailable)' # Detailed section's icon, reused below
+
+                if icon_code:
+                    icon_code_str, image_cid = icon_meta[icon_code]
+
                     icon_bytes = fetched_icons[icon_code_str]
-                    if icon_bytes and not any(cid == image_cid for _, cid in email_images):
-                         # Add to email list only if not already added for this CID
-                         email_images.append((icon_bytes, image_cid))
-
-                if fetched_icons[icon_code_str]:
-                    html_content += f"""
-                    <div class="summary-item">
-                      <div class="summary-day">{day_name}</div>
-                      <img src="cid:{image_cid}" alt="{weather_desc}" class="summary-icon-small" title="{weather_desc}">
-                    </div>
-                    """
-                else:
-                    # Icon fetch failed
-                    html_content += f"""
-                    <div class="summary-item">
-                      <div class="summary-day">{day_name}</div>
-                      ({weather_desc})
-                    </div>
-                    """
-            else: # No icon code provided
-                 html_content += f"""
-                    <div class="summary-item">
-                      <div class="summary-day">{day_name}</div>
-                      ({weather_desc})
-                    </div>
-                    """
-
-        html_content += """
-          </div>
-        """ # End summary container
-
-        # --- Create Detailed Daily Forecast Sections ---
-        for day_forecast in forecast_data:
-            icon_code = day_forecast.get('icon')
-            date_str = day_forecast.get('date_str', 'no_date')
-            weather_desc = day_forecast.get('weather_desc', 'N/A')
-            img_tag = '(icon unavailable)' # Default
-
-            if icon_code:
-                icon_code_str = str(icon_code).zfill(2)
-                # Use the same CID logic as summary, assuming icon is already fetched/cached
-                image_cid = f"summary_icon_{date_str}_{icon_code_str}" # Reference the potentially cached icon
-
-                if fetched_icons.get(icon_code_str): # Check if fetch was successful
-                    img_tag = f'<img src="cid:{image_cid}" alt="{weather_desc}" class="weather-icon" title="{weather_desc}">'
-                else:
-                    img_tag = f'({weather_desc} - icon unavailable)'
-
-
-            html_content += f"""
-            <div class="day-forecast">
-              <h2>{day_forecast.get('day_name', '')}, {day_forecast.get('date_obj').strftime('%B %d') if day_forecast.get('date_obj') else ''}</h2>
-              <p>
-                {img_tag} <br>
-                <span class="detail-label"><strong>Weather:</strong></span> {weather_desc} <br>
-                <span class="detail-label"><strong>🌡️ High/Low:</strong></span> {day_forecast.get('high_temp', 'N/A')}°C / {day_forecast.get('low_temp', 'N/A')}°C <br>
-                <span class="detail-label"><strong>💨 Wind:</strong></span> {day_forecast.get('wind_speed', 'N/A')} m/s ({day_forecast.get('wind_direction', 'N/A')}) <br>
-                <span class="detail-label"><strong>💧 Humidity:</strong></span> {day_forecast.get('humidity', 'N/A')} <br> <span class="detail-label"><strong>🌧️ Precip:</strong></span> {day_forecast.get('precipitation', 'N/A')} mm ({day_forecast.get('precip_chance', 'N/A')}% chance) <br>
-                <span class="detail-label"><strong>☀️ UV Index:</strong></span> {day_forecast.get('uv_index', 'N/A')} <br>
-                <span class="detail-label"><strong>🌅 Sunrise:</strong></span> {day_forecast.get('sunrise', 'N/A')} / <strong>🌇 Sunset:</strong> {day_forecast.get('sunset', 'N/A')}
-              </p>
-            </div>
-            """
-
-        html_content += """
-          <p><i>Weather data provided by AccuWeather.</i></p> </body>
-        </html>
-        """
-
-        # --- Send Email ---
-        logging.info("Sending AccuWeather forecast email...")
-        send_email_with_images(
-            gmail_user,
-            gmail_password,
-            to_email,
-            email_subject,
-            html_content,
-            email_images # Pass the list of images to embed
-        )
-    else:
-        logging.error("Failed to retrieve AccuWeather forecast data. Email not sent.")
+                    if icon_bytes:
+                        if image_cid not in added_cids:
+                            email_images.append((icon_bytes, image_cid))
+                            added_cids.add(image_cid)
+                        icon_html = f'<img src="cid:{image_cid}" alt="{weather_desc}" class="summary-icon-small" title="{weather_desc}">'
+                        day_forecast["_img_tag"] = f'<img src="cid:{image_cid}" alt="{weather_desc}" class="weather-icon" title="{weather_desc}">'
+                    else:
+                        day_forecast["_img_tag"] = f'({weather_desc} - icon unavailable)'
+
+                summary_items.append(render_summary_item(day_forecast.get('day_name', 'N/A'), icon_html))
+
+            # --- Create Detailed Daily Forecast Sections ---
+            day_sections = [render_day_section(day_forecast, day_forecast["_img_tag"]) for day_forecast in forecast_data]
+
+            html_content = render_email_html(actual_days, city, "".join(summary_items), "".join(day_sections))
+
+            # --- Skip Unchanged Emails ---
+            # Compared after rendering so a new recipient or layout is always sent. The background
+            # SMTP login is then wasted, but that only happens on reruns (e.g. run_on_startup).
+            email_digest = get_email_digest(gmail_user, to_email, email_subject, html_content)
+            if email_digest == read_last_email_digest():
+                logger.info("Email identical to the last one sent; skipping email.")
+                logger.info("WeatherNotifier function finished.")
+                return
+
+            # --- Send Email ---
+            logger.info("Sending AccuWeather forecast email...")
+            try:
+                smtp_server = smtp_future.result()
+            except OSError as e: # Includes smtplib.SMTPException
+                logger.error(f"Error connecting to SMTP server: {e}. Email not sent.")
+                return
+            smtp_handed_off = True # send_email_with_images closes the connection from here on
+            email_sent = send_email_with_images(
+                smtp_server,
+                gmail_user,
+                to_email,
+                email_subject,
+                html_content,
+                email_images # Pass the list of images to embed
+            )
+            if email_sent:
+                write_last_email_digest(email_digest)
+        else:
+            logger.error("Failed to retrieve AccuWeather forecast data. Email not sent.")
+    finally:
+        if not smtp_handed_off:
+            close_smtp(smtp_future)
 
-    logging.info("WeatherNotifier function finished.")
\ No newline at end of file
+    logger.info("WeatherNotifier function finished.")
\ No newline at end of file